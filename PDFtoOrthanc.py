@@ -33,16 +33,28 @@ Licença: GPLv3 ou posterior
 import os
 import re
 import base64
+import binascii
 import shutil
+import time
+import random
 import datetime as dt
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+import queue
 import json
+import email.utils
+import functools
+import itertools
+import contextlib
+import threading
 import unicodedata
+import uuid
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Dict, Any, Tuple, List
+from types import MappingProxyType
+from typing import Dict, Any, Tuple, List, Mapping, Iterator
 
 import requests
+from requests.adapters import HTTPAdapter
 
 # -------------------------- CONFIGURAÇÕES (via ENV) --------------------------
 ORTHANC_URL = os.getenv("ORTHANC_URL", "http://localhost:8042").rstrip("/")
@@ -57,12 +69,29 @@ LOG_PATH = os.getenv("PDFFLOW_LOG", os.path.join(PDF_SOURCE_FOLDER, "pdftoorthan
 
 CREATE_DATE_FOLDERS = os.getenv("CREATE_DATE_FOLDERS", "true").lower() == "true"
 SKIP_DUP_CHECK = os.getenv("SKIP_DUP_CHECK", "false").lower() == "true"
-MAX_WORKERS = int(os.getenv("MAX_WORKERS", "2"))  # ajustar conforme capacidade do servidor
+# UIDs derivados dos dados do exame: reenviar o mesmo PDF gera o mesmo SOPInstanceUID e o Orthanc responde AlreadyStored
+USE_DETERMINISTIC_UIDS = os.getenv("USE_DETERMINISTIC_UIDS", "false").lower() == "true"
+# Envio é limitado por rede, não por CPU: o padrão acompanha os núcleos com folga e teto de 32
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", str(min(32, (os.cpu_count() or 1) * 4))))
+# Cada arquivo faz até 4 consultas de duplicado: 1 na thread do worker e até 3 no pool de consultas.
+# O pool HTTP comporta workers + consultas em paralelo, sem descartar conexões ("Connection pool is full")
+PROBE_THREADS = max(1, MAX_WORKERS) * 3
+HTTP_POOL_SIZE = max(1, MAX_WORKERS) + PROBE_THREADS
 MAX_RETRIES = int(os.getenv("MAX_RETRIES", "3"))
 BACKOFF_BASE_SEC = float(os.getenv("BACKOFF_BASE_SEC", "1.5"))
+BACKOFF_MAX_SEC = float(os.getenv("BACKOFF_MAX_SEC", "30"))  # teto de cada espera entre tentativas
 MAX_FILE_MB = float(os.getenv("MAX_FILE_MB", "50"))  # preventiva, ajuste conforme Orthanc
+# Limit das consultas em lote; não deve passar do LimitFindResults do Orthanc. Resposta com
+# FIND_LIMIT itens pode ter sido truncada e não prova ausência
+FIND_LIMIT = int(os.getenv("FIND_LIMIT", "100"))
+# Espera base por tentativa (o jitter é aplicado na hora)
+RETRY_WAITS = tuple(min(BACKOFF_MAX_SEC, BACKOFF_BASE_SEC ** a) for a in range(1, MAX_RETRIES + 1))
 
 SOPCLASS_PDF = '1.2.840.10008.5.1.4.1.1.104.1'
+UID_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, "https://github.com/byweber/PDFtoOrthanc")
+B64_CHUNK = 57 * 1024  # múltiplo de 3: base64 sem padding no meio do fluxo
+PDF_PROBE_BYTES = 1024  # janela lida no início/fim do arquivo na validação do PDF
+ACCESSION_BATCH = 50  # AccessionNumbers por consulta em lote ao /tools/find (folga abaixo de FIND_LIMIT)
 
 FIXED_EXAM = {
     "Type": os.getenv("EXAM_TYPE", "ELETROCARDIOGRAMA"),
@@ -72,6 +101,18 @@ FIXED_EXAM = {
 INSTITUTION_NAME = os.getenv("INSTITUTION_NAME", "HOSPITAL DIGITAL")
 REFERRING_PHYSICIAN = os.getenv("REFERRING_PHYSICIAN", "AUTOMATIZADO")
 
+# Tags iguais para todos os arquivos; process_file só acrescenta as do paciente/estudo
+STATIC_TAGS = {
+    "StudyDescription": FIXED_EXAM['Type'],
+    "SeriesDescription": f"{FIXED_EXAM['Type']} - PDF",
+    "SeriesNumber": "1",
+    "Modality": FIXED_EXAM['Modality'],
+    "InstanceNumber": "1",
+    "InstitutionName": INSTITUTION_NAME,
+    "ReferringPhysicianName": REFERRING_PHYSICIAN,
+    "SOPClassUID": SOPCLASS_PDF
+}
+
 # -------------------------- LOGGING --------------------------
 logger = logging.getLogger("pdftoorthanc")
 logger.setLevel(logging.INFO)
@@ -86,85 +127,164 @@ os.makedirs(os.path.dirname(LOG_PATH), exist_ok=True)
 fh = RotatingFileHandler(LOG_PATH, maxBytes=5 * 1024 * 1024, backupCount=5, encoding='utf-8')
 fh.setFormatter(fmt)
 logger.addHandler(fh)
+# Durante a execução (main), workers só enfileiram; formatação, escrita e rotação ficam na
+# thread do listener. Nada é iniciado na importação
+log_queue = queue.Queue(-1)
+log_queue_handler = QueueHandler(log_queue)
+log_listener = QueueListener(log_queue, ch, fh, respect_handler_level=True)
+
+
+# Encoder e níveis resolvidos uma vez: jlog é chamado várias vezes por arquivo
+_json_encode = json.JSONEncoder(ensure_ascii=False).encode
+LOG_LEVELS = {name: getattr(logging, name.upper()) for name in ('debug', 'info', 'warning', 'error', 'critical')}
 
 
 def jlog(level: str, **fields):
     """Log JSON-like (campo 'msg' opcional)."""
-    msg = json.dumps(fields, ensure_ascii=False)
-    logger.log(getattr(logging, level.upper(), logging.INFO), msg)
+    lvl = LOG_LEVELS.get(level, logging.INFO)
+    # Evita serializar eventos que o nível configurado descartaria
+    if not logger.isEnabledFor(lvl):
+        return
+    logger.log(lvl, _json_encode(fields))
 
 
 # -------------------------- UTIL --------------------------
-REGEX_ID = re.compile(r'^\d+$')  # Somente dígitos
-REGEX_DATE = re.compile(r'^(\d{6}|\d{8})$')  # 6 ou 8 dígitos
+TODAY_DICOM = dt.date.today().strftime('%Y%m%d')  # data de fallback, fixa para a execução
+REGEX_NON_ALPHA = re.compile(r'[^A-Za-z\s]')  # Números e pontuação
+REGEX_HAS_DIGIT = re.compile(r'\d')  # Os dois formatos exigem ao menos a data numérica
+# ESTRUTURADO "limpo" (ASCII, sem acentos nem espaços) num único match: ID_NOME_SOBRENOME[_...]_DATA_ACC
+REGEX_ESTRUTURADO = re.compile(r'([0-9]+)_((?:[A-Za-z]+_){2,})([0-9]{6}|[0-9]{8})_([0-9]+)')
+# Equivalente ASCII do REGEX_NON_ALPHA: o que não é letra nem espaço vira espaço
+NON_ALPHA_TABLE = str.maketrans({chr(c): ' ' for c in range(128)
+                                 if not (chr(c).isalpha() or chr(c).isspace())})
+NAME_CHARS = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZ ")  # Letras maiúsculas e espaços
+# Letras acentuadas do português já sem acento (mesmo resultado de NFKD sem marcas combinantes)
+ACCENT_TABLE = str.maketrans({
+    ch: ''.join(c for c in unicodedata.normalize('NFKD', ch) if not unicodedata.combining(c))
+    for ch in 'áàâãäéèêëíìîïóòôõöúùûüçñÁÀÂÃÄÉÈÊËÍÌÎÏÓÒÔÕÖÚÙÛÜÇÑ'
+})
+
+
+def is_numeric_id(token: str) -> bool:
+    # Somente dígitos (equivale a ^\d+$ sem passar pelo motor de regex)
+    return token.isdecimal()
+
+
+def is_date_token(token: str) -> bool:
+    # 6 ou 8 dígitos (equivale a ^(\d{6}|\d{8})$ sem passar pelo motor de regex)
+    return len(token) in (6, 8) and token.isdecimal()
+
+
+@functools.lru_cache(maxsize=None)
+def ensure_dir(path: str) -> None:
+    # Cria a pasta uma vez por execução: em compartilhamento de rede cada makedirs é uma ida ao servidor
+    os.makedirs(path, exist_ok=True)
 
 
 def ensure_dirs():
     for d in [PROCESSED_PATH, ERROR_PATH, DUPLICATE_PATH]:
-        os.makedirs(d, exist_ok=True)
+        ensure_dir(d)
 
 
+@functools.lru_cache(maxsize=1024)
 def build_date_folder_path(base: str, study_date: str) -> str:
+    # Memorizado: o lote costuma ter poucas datas, repetidas em todos os arquivos
     if CREATE_DATE_FOLDERS and study_date and len(study_date) >= 8:
         date_folder = f"{study_date[0:4]}-{study_date[4:6]}-{study_date[6:8]}"
         return os.path.join(base, date_folder)
     return base
 
 
+@functools.lru_cache(maxsize=4096)
 def normalize_name_token(token: str) -> str:
-    # Normaliza Unicode, remove marcas combinantes (acentos), mantém letras e espaços
+    # Normaliza Unicode, remove marcas combinantes (acentos), mantém letras e espaços.
+    # Memorizado: nomes e sobrenomes se repetem muito no lote (SILVA, SANTOS, MARIA...)
     token = token.strip()
-    token = unicodedata.normalize('NFKD', token)
-    token = ''.join(ch for ch in token if not unicodedata.combining(ch))
-    token = re.sub(r"[^A-Za-z\s]", " ", token)  # remove números e pontuação
-    token = re.sub(r"\s+", " ", token).strip()
+    if not token.isascii():
+        # Acentos comuns saem pela tabela (loop em C); NFKD só para o que ainda sobrar
+        token = token.translate(ACCENT_TABLE)
+        if not token.isascii():
+            token = unicodedata.normalize('NFKD', token)
+            token = ''.join(ch for ch in token if not unicodedata.combining(ch))
+    if token.isascii():
+        token = token.translate(NON_ALPHA_TABLE)  # remove números e pontuação
+    else:
+        token = REGEX_NON_ALPHA.sub(" ", token)
+    token = ' '.join(token.split())  # colapsa espaços (split() já descarta as pontas)
     return token.upper()
 
 
 def is_valid_name_part(token: str) -> bool:
-    # Alterado para {1,} para aceitar conectivos ("e") e iniciais ("J")
-    return bool(token) and re.fullmatch(r"[A-Z ]{1,}", token) is not None
+    # Mínimo de 1 caractere para aceitar conectivos ("e") e iniciais ("J")
+    return bool(token) and NAME_CHARS.issuperset(token)
 
 
 def format_dicom_date(date_str: str) -> str:
     """Retorna YYYYMMDD. Suporta DDMMYY, DDMMYYYY, YYYYMMDD. Pivot YY >=70 => 19xx, senão 20xx."""
-    if not date_str or not REGEX_DATE.match(date_str):
-        return dt.datetime.now().strftime('%Y%m%d')
+    if not date_str:
+        return TODAY_DICOM
+    if len(date_str) == 8 and date_str[:2] in ("19", "20") and date_str.isascii() and date_str.isdecimal():
+        # Já em YYYYMMDD: devolve a própria string. Um DDMMYYYY de 1900 a 2099 nunca
+        # é aceito aqui, porque o "mês" lido seria o século do ano (19 ou 20)
+        try:
+            dt.date(int(date_str[0:4]), int(date_str[4:6]), int(date_str[6:8]))
+            return date_str
+        except ValueError:
+            pass
+    if not is_date_token(date_str):
+        return TODAY_DICOM
     try:
         if len(date_str) == 6:
             dd, mm, yy = int(date_str[0:2]), int(date_str[2:4]), int(date_str[4:6])
             year = 1900 + yy if yy >= 70 else 2000 + yy
-            d = dt.date(year, mm, dd)
-        elif len(date_str) == 8:
-            if date_str[:4] in ("19" + date_str[6:8], "20" + date_str[6:8]):
-                # já pode estar em YYYYMMDD
-                year, mm, dd = int(date_str[0:4]), int(date_str[4:6]), int(date_str[6:8])
-                d = dt.date(year, mm, dd)
-            else:
-                # assumir DDMMYYYY
-                dd, mm, year = int(date_str[0:2]), int(date_str[2:4]), int(date_str[4:8])
-                d = dt.date(year, mm, dd)
         else:
-            d = dt.date.today()
-        return d.strftime('%Y%m%d')
+            # DDMMYYYY (YYYYMMDD válido já saiu acima)
+            dd, mm, year = int(date_str[0:2]), int(date_str[2:4]), int(date_str[4:8])
+        dt.date(year, mm, dd)  # só valida; a saída é montada sem strftime
+        return f"{year:04d}{mm:02d}{dd:02d}"
     except Exception:
-        return dt.datetime.now().strftime('%Y%m%d')
+        return TODAY_DICOM
+
+
+COLLISION_SEQ = itertools.count(1)  # sufixo para nomes já existentes no destino (compartilhado pelos workers)
 
 
 def move_file_safe(source: str, dest_folder: str, study_date: str) -> str:
     final_folder = build_date_folder_path(dest_folder, study_date)
-    os.makedirs(final_folder, exist_ok=True)
+    ensure_dir(final_folder)
     filename = os.path.basename(source)
     dest = os.path.join(final_folder, filename)
     if os.path.exists(dest):
-        ts = dt.datetime.now().strftime('%H%M%S')
+        # Sequencial em vez de horário: nunca repete na execução, e o laço pula nomes de execuções anteriores
         base, ext = os.path.splitext(filename)
-        dest = os.path.join(final_folder, f"{base}-{ts}{ext}")
+        while os.path.exists(dest):
+            dest = os.path.join(final_folder, f"{base}-{next(COLLISION_SEQ):04d}{ext}")
     shutil.move(source, dest)
     jlog("info", event="file_moved", src=source, dest=dest)
     return dest
 
 
+def check_pdf_integrity(pdf_path: str, size_bytes: int) -> str | None:
+    """
+    Validação rápida do PDF: tamanho mínimo de 1 KB, cabeçalho %PDF- no início
+    e marcador %%EOF no fim. Usa o tamanho já obtido na listagem e lê apenas as
+    duas janelas fixas, sem buffer (evita read-ahead em compartilhamentos de rede).
+    Retorna o motivo da falha ou None.
+    """
+    if size_bytes < PDF_PROBE_BYTES:
+        return 'Arquivo menor que 1 KB'
+    try:
+        with open(pdf_path, 'rb', buffering=0) as f:
+            if b'%PDF-' not in f.read(PDF_PROBE_BYTES):
+                return 'Cabeçalho %PDF- ausente'
+            f.seek(size_bytes - PDF_PROBE_BYTES)
+            if b'%%EOF' not in f.read(PDF_PROBE_BYTES):
+                return 'Marcador %%EOF ausente'
+    except OSError as e:
+        return f"Falha ao ler o arquivo: {e}"
+    return None
+
+
 # -------------------------- PARSING DE ARQUIVOS --------------------------
 
 def _parse_dicom_name_parts(name_parts: List[str]) -> Tuple[str, str, str]:
@@ -200,11 +320,11 @@ def validate_parts(parts):
     patient_id = parts[0]
     date_str = parts[-2]
     acc_num = parts[-1]
-    if not REGEX_ID.match(patient_id):
+    if not is_numeric_id(patient_id):
         return 'PatientID deve ser somente números'
-    if not REGEX_DATE.match(date_str):
+    if not is_date_token(date_str):
         return 'Data inválida'
-    if not REGEX_ID.match(acc_num):
+    if not is_numeric_id(acc_num):
         return 'AccessionNumber deve ser somente números'
     # Valida nome (tokens entre PatientID e Data)
     for p in parts[1:-2]:
@@ -214,45 +334,73 @@ def validate_parts(parts):
     return None
 
 
-def parse_filename(filename: str) -> Dict[str, Any]:
+@functools.lru_cache(maxsize=4096)
+def parse_filename(filename: str) -> Mapping[str, Any]:
+    """
+    Resultado em cache por nome de arquivo (main e process_file analisam o mesmo
+    nome). O dicionário é compartilhado, por isso é devolvido somente leitura.
+    """
+    return MappingProxyType(_parse_filename(filename))
+
+
+def _invalid_parse_result() -> Dict[str, Any]:
+    return {
+        'IsValid': False,
+        'Format': 'INVALIDO',
+        'PatientID': '',
+        'FirstName': 'ERRO',
+        'MiddleName': '',
+        'LastName': 'FORMATO',
+        'DateString': '',
+        'StudyDate': TODAY_DICOM,
+        'AccessionNumber': '',
+        'HasIds': False,
+        'Error': 'Formato inválido'
+    }
+
+
+def _structured_result(patient_id: str, name_parts: List[str], date_str: str,
+                       accession_number: str) -> Dict[str, Any]:
+    first_name, middle_name, last_name = _parse_dicom_name_parts(name_parts)
+    study_date = format_dicom_date(date_str)
+    return {
+        'IsValid': True,
+        'Format': 'ESTRUTURADO',
+        'PatientID': patient_id,
+        'FirstName': first_name,
+        'MiddleName': middle_name,
+        'LastName': last_name,
+        'DateString': date_str,
+        'StudyDate': study_date,
+        'AccessionNumber': accession_number,
+        'HasIds': True,
+        'Error': None
+    }
+
+
+def _parse_filename(filename: str) -> Dict[str, Any]:
     base = os.path.splitext(filename)[0]
+    m = REGEX_ESTRUTURADO.fullmatch(base)
+    if m:
+        # Caso comum: tokens de nome só com letras ASCII já estão válidos, basta passar para maiúsculas
+        patient_id, names, date_str, accession_number = m.groups()
+        return _structured_result(patient_id, names[:-1].upper().split('_'), date_str, accession_number)
+    if not REGEX_HAS_DIGIT.search(base):
+        # Sem nenhum dígito não há data: inválido sem normalizar tokens
+        return _invalid_parse_result()
     parts_raw = base.split('_')
     parts = [p.strip() for p in parts_raw if p.strip()]
     err = validate_parts(parts)
     if not err:
-        patient_id = parts[0]
-        date_str = parts[-2]
-        accession_number = parts[-1]
-        name_parts_raw = parts[1:-2]
-
-        name_parts = [normalize_name_token(p) for p in name_parts_raw]
-        first_name, middle_name, last_name = _parse_dicom_name_parts(name_parts)
-
-        study_date = format_dicom_date(date_str)
-        return {
-            'IsValid': True,
-            'Format': 'ESTRUTURADO',
-            'PatientID': patient_id,
-            'FirstName': first_name,
-            'MiddleName': middle_name,
-            'LastName': last_name,
-            'DateString': date_str,
-            'StudyDate': study_date,
-            'AccessionNumber': accession_number,
-            'HasIds': True,
-            'Error': None
-        }
+        name_parts = [normalize_name_token(p) for p in parts[1:-2]]
+        return _structured_result(parts[0], name_parts, parts[-2], parts[-1])
 
     # LEGADO: procurar último token de data válido
     date_index = -1
     for i in range(len(parts) - 1, -1, -1):
-        if REGEX_DATE.match(parts[i]):
-            try:
-                _ = format_dicom_date(parts[i])
-                date_index = i
-                break
-            except Exception:
-                continue
+        if is_date_token(parts[i]):
+            date_index = i
+            break
 
     if date_index > 0 and date_index >= 2:  # Precisa de pelo menos Nome_Sobrenome_Data
         name_parts_raw = parts[:date_index]
@@ -274,19 +422,7 @@ def parse_filename(filename: str) -> Dict[str, Any]:
             'Error': None
         }
 
-    return {
-        'IsValid': False,
-        'Format': 'INVALIDO',
-        'PatientID': '',
-        'FirstName': 'ERRO',
-        'MiddleName': '',
-        'LastName': 'FORMATO',
-        'DateString': '',
-        'StudyDate': dt.datetime.now().strftime('%Y%m%d'),
-        'AccessionNumber': '',
-        'HasIds': False,
-        'Error': 'Formato inválido'
-    }
+    return _invalid_parse_result()
 
 
 # -------------------------- ORTHANC --------------------------
@@ -300,195 +436,587 @@ def get_auth_header(user: str, password: str) -> Dict[str, str]:
     return headers
 
 
-def req_with_retry(method: str, url: str, session: requests.Session, headers: Dict[str, str],
-                   json_body: Dict[str, Any] | None = None, timeout: float = 60.0) -> requests.Response:
+# Cabeçalhos fixos de todas as chamadas ao Orthanc (todas trocam JSON), montados uma vez
+BASE_HEADERS = {**get_auth_header(ORTHANC_USER, ORTHANC_PASSWORD),
+                'Content-Type': 'application/json', 'Accept': 'application/json'}
+
+
+def create_session(headers: Dict[str, str]) -> requests.Session:
+    """
+    Sessão HTTP única para toda a execução (keep-alive): evita um novo handshake
+    TCP/TLS a cada chamada. O pool do urllib3 é thread-safe, então a mesma sessão
+    é compartilhada pelos workers. Retentativas ficam a cargo de req_with_retry.
+    Os cabeçalhos fixos (BASE_HEADERS) ficam na sessão, sem cópia por chamada.
+    """
+    session = requests.Session()
+    session.headers.update(headers)
+    adapter = HTTPAdapter(pool_maxsize=HTTP_POOL_SIZE, max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+RETRYABLE_4XX = (408, 429)  # timeout do pedido e limite de taxa: vale tentar de novo
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Segundos pedidos pelo servidor no Retry-After (número ou data HTTP); None se ausente ou inválido."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=dt.timezone.utc)
+    return max(0.0, (when - dt.datetime.now(dt.timezone.utc)).total_seconds())
+
+
+class SourceFileChanged(Exception):
+    """O arquivo mudou de tamanho depois da listagem; reenviar o mesmo corpo não adianta."""
+
+
+def req_with_retry(method: str, url: str, session: requests.Session, json_body: Dict[str, Any] | None = None,
+                   timeout: float = 60.0, data: Any = None) -> requests.Response:
+    # Cabeçalhos (autenticação, JSON) vêm da sessão; nenhuma chamada precisa de extras
     last_exc = None
     for attempt in range(1, MAX_RETRIES + 1):
         try:
-            r = session.request(method=method, url=url, headers=headers, json=json_body, timeout=timeout)
+            if hasattr(data, 'seek'):
+                data.seek(0)  # corpo em streaming: cada tentativa envia desde o início
+            r = session.request(method=method, url=url, json=json_body, data=data, timeout=timeout)
             r.raise_for_status()
             return r
+        except SourceFileChanged:
+            raise  # falha determinística, como um 4xx: não há o que repetir
         except Exception as e:
             last_exc = e
-            wait = BACKOFF_BASE_SEC ** attempt
+            response = e.response if isinstance(e, requests.HTTPError) else None
+            status = response.status_code if response is not None else None
+            if status is not None and 400 <= status < 500 and status not in RETRYABLE_4XX:
+                raise  # erro do pedido (autenticação, corpo inválido): repetir não muda a resposta
+            if attempt == MAX_RETRIES:
+                break  # sem espera depois da última tentativa
+            wait = parse_retry_after(response.headers.get('Retry-After')) if status in (429, 503) else None
+            if wait is None:
+                # Jitter: workers que falharam juntos não voltam todos no mesmo instante
+                wait = RETRY_WAITS[attempt - 1] * random.uniform(0.5, 1.5)
+            wait = min(wait, BACKOFF_MAX_SEC)
             jlog("warning", event="http_retry", attempt=attempt, wait_s=round(wait, 2), url=url, error=str(e))
-            try:
-                import time
-                time.sleep(wait)
-            except Exception:
-                pass
+            time.sleep(wait)
     raise last_exc  # esgota as tentativas
 
 
-def test_orthanc_connection(url: str, headers: Dict[str, str]) -> Tuple[bool, str]:
-    with requests.Session() as s:
+def load_json(r: requests.Response) -> Any:
+    # json.loads direto dos bytes (detecta UTF-8/16/32): sem decodificar para str nem adivinhar o encoding
+    return json.loads(r.content)
+
+
+def test_orthanc_connection(url: str, session: requests.Session) -> Tuple[bool, str]:
+    try:
+        r = req_with_retry("GET", f"{url}/system", session, timeout=10)
+        version = load_json(r).get('Version', '')
+        return True, version
+    except Exception as e:
+        return False, str(e)
+
+
+def prefetch_accessions(accessions: List[str], url: str, session: requests.Session) -> Dict[str, str | None]:
+    """
+    Consulta em lote quais AccessionNumbers já existem no Orthanc, usando list
+    matching do /tools/find (valores separados por '\\'). Retorna
+    {AccessionNumber: study_id ou None}. Accessions de um lote que falhou, ou
+    cuja resposta veio cheia (possivelmente truncada), ficam fora do dicionário
+    e seguem para a busca individual em find_duplicate.
+    """
+    known: Dict[str, str | None] = {}
+    unique = sorted(set(accessions))
+    for i in range(0, len(unique), ACCESSION_BATCH):
+        batch = unique[i:i + ACCESSION_BATCH]
+        body = {"Level": "Study", "Expand": True, "Limit": FIND_LIMIT,
+                "Query": {"AccessionNumber": "\\".join(batch)}}
         try:
-            r = req_with_retry("GET", f"{url}/system", s, headers, timeout=10)
-            version = r.json().get('Version', '')
-            return True, version
+            r = req_with_retry("POST", f"{url}/tools/find", session, json_body=body, timeout=60)
+            studies = load_json(r)
         except Exception as e:
-            return False, str(e)
+            jlog("warning", event="prefetch_accessions_failed", count=len(batch), error=str(e))
+            continue
+        found = {study.get('MainDicomTags', {}).get('AccessionNumber'): study['ID'] for study in studies}
+        if len(studies) >= FIND_LIMIT:
+            # Resposta possivelmente truncada: só os encontrados são certos
+            jlog("warning", event="prefetch_accessions_truncated", count=len(batch), limit=FIND_LIMIT)
+            known.update((acc, study_id) for acc, study_id in found.items() if acc in batch)
+            continue
+        for acc in batch:
+            known[acc] = found.get(acc)
+    jlog("info", event="prefetch_accessions", queried=len(unique), resolved=len(known),
+         existing=sum(1 for v in known.values() if v))
+    return known
+
+
+def normalize_patient_name(value: str) -> str:
+    # Comparação local no mesmo espírito do Orthanc com CaseSensitivePN=false: sem acentos e em maiúsculas
+    value = unicodedata.normalize('NFKD', value.strip())
+    return ''.join(ch for ch in value if not unicodedata.combining(ch)).upper()
+
+
+def fetch_study_date_index(study_date: str, url: str,
+                           session: requests.Session) -> Tuple[Dict[Tuple[str, str], str] | None, int]:
+    """
+    Busca os estudos de uma StudyDate e indexa por PatientID e PatientName.
+    Retorna (índice, nº de estudos); o índice é None se a consulta falhou ou
+    veio cheia (FIND_LIMIT itens), pois aí a data não está coberta por completo.
+    """
+    body = {"Level": "Study", "Expand": True, "Limit": FIND_LIMIT, "Query": {"StudyDate": study_date}}
+    try:
+        r = req_with_retry("POST", f"{url}/tools/find", session, json_body=body, timeout=60)
+        studies = load_json(r)
+    except Exception as e:
+        jlog("warning", event="prefetch_study_date_failed", study_date=study_date, error=str(e))
+        return None, 0
+    if len(studies) >= FIND_LIMIT:
+        jlog("warning", event="prefetch_study_date_truncated", study_date=study_date, limit=FIND_LIMIT)
+        return None, len(studies)
+    index: Dict[Tuple[str, str], str] = {}
+    for study in studies:
+        patient = study.get('PatientMainDicomTags', {})
+        patient_id = patient.get('PatientID', '').strip()
+        patient_name = normalize_patient_name(patient.get('PatientName', ''))
+        if patient_id:
+            index.setdefault(('PatientID', patient_id), study['ID'])
+        if patient_name:
+            index.setdefault(('PatientName', patient_name), study['ID'])
+    return index, len(studies)
+
+
+def prefetch_study_dates(study_dates: List[str], url: str,
+                         session: requests.Session) -> Dict[str, Dict[Tuple[str, str], str]]:
+    """
+    Busca todos os estudos de cada StudyDate do lote (uma consulta por data
+    distinta, em paralelo). Retorna {StudyDate: {(campo, valor): study_id}}; uma
+    data presente no dicionário está coberta por completo, então ausência no
+    índice significa que não há estudo. Datas cuja consulta falhou ou veio
+    truncada ficam de fora e seguem para a busca individual.
+    """
+    dates = sorted(set(study_dates))
+    known: Dict[str, Dict[Tuple[str, str], str]] = {}
+    studies_total = 0
+    if not dates:
+        return known
+    with ThreadPoolExecutor(max_workers=max(1, min(MAX_WORKERS, len(dates))), thread_name_prefix="prefetch") as ex:
+        results = ex.map(lambda d: fetch_study_date_index(d, url, session), dates)
+        for study_date, (index, count) in zip(dates, results):
+            studies_total += count
+            if index is not None:
+                known[study_date] = index
+    jlog("info", event="prefetch_study_dates", queried=len(dates), resolved=len(known), studies=studies_total)
+    return known
+
+
+def register_uploaded_study(study_id: str, accession: str, patient_id: str, patient_names: List[str],
+                            study_date: str, known_accessions: Dict[str, str | None] | None,
+                            known_dates: Dict[str, Dict[Tuple[str, str], str]] | None) -> None:
+    """Atualiza os índices locais com o estudo recém-criado, para que arquivos seguintes do lote o encontrem."""
+    forget_missing_studies(accession, study_date)
+    if known_accessions is not None and accession:
+        known_accessions[accession] = study_id
+    date_index = known_dates.get(study_date) if known_dates is not None else None
+    if date_index is not None:
+        if patient_id:
+            date_index.setdefault(('PatientID', patient_id), study_id)
+        for name in patient_names:
+            if name:
+                date_index.setdefault(('PatientName', normalize_patient_name(name)), study_id)
+
+
+_KEY_LOCKS: Dict[Tuple[str, ...], threading.Lock] = {}
+_KEY_LOCKS_GUARD = threading.Lock()
+
+
+def duplicate_keys(parsed: Mapping, patient_names: List[str]) -> List[Tuple[str, ...]]:
+    """Chaves usadas pela verificação de duplicidade de um arquivo (mesmo formato dos índices pré-carregados)."""
+    keys: List[Tuple[str, ...]] = []
+    if parsed['AccessionNumber']:
+        keys.append(('AccessionNumber', parsed['AccessionNumber']))
+    if parsed['PatientID']:
+        keys.append((parsed['StudyDate'], 'PatientID', parsed['PatientID']))
+    for name in patient_names:
+        if name:
+            keys.append((parsed['StudyDate'], 'PatientName', normalize_patient_name(name)))
+    return sorted(set(keys))
+
+
+@contextlib.contextmanager
+def duplicate_key_guard(keys: List[Tuple[str, ...]]) -> Iterator[None]:
+    """Segura um lock por chave (em ordem, sem risco de deadlock) enquanto o bloco executa."""
+    with _KEY_LOCKS_GUARD:
+        locks = [_KEY_LOCKS.setdefault(key, threading.Lock()) for key in keys]
+    with contextlib.ExitStack() as stack:
+        for lock in locks:
+            stack.enter_context(lock)
+        yield
+
+
+_FIND_CACHE: Dict[Tuple[Tuple[str, str], ...], str | None] = {}
+_FIND_CACHE_LOCK = threading.Lock()
+
+
+def find_study(query: Dict[str, str], url: str, session: requests.Session) -> str | None:
+    """
+    /tools/find em nível Study com memória para a execução: a mesma consulta
+    (reenvios do mesmo estudo no lote) vai à rede uma vez só. Falhas de rede não
+    ficam guardadas; resultados negativos são esquecidos quando um envio cria
+    o estudo (forget_missing_studies).
+    """
+    key = tuple(sorted(query.items()))
+    with _FIND_CACHE_LOCK:
+        if key in _FIND_CACHE:
+            return _FIND_CACHE[key]
+    r = req_with_retry("POST", f"{url}/tools/find", session, json_body={"Level": "Study", "Query": query},
+                       timeout=30)
+    data = load_json(r)
+    study_id = data[0] if data else None
+    with _FIND_CACHE_LOCK:
+        _FIND_CACHE[key] = study_id
+    return study_id
+
+
+def forget_missing_studies(accession: str, study_date: str) -> None:
+    """Descarta os "não encontrado" guardados que o estudo recém-criado pode ter tornado falsos."""
+    stale = {('AccessionNumber', accession), ('StudyDate', study_date)}
+    with _FIND_CACHE_LOCK:
+        for key in [k for k, v in _FIND_CACHE.items() if v is None and not stale.isdisjoint(k)]:
+            del _FIND_CACHE[key]
+
+
+def run_network_probes(probes: List[Tuple[str, str, Dict[str, str], str, Dict[str, str]]], url: str,
+                       session: requests.Session,
+                       probe_pool: ThreadPoolExecutor | None = None) -> Tuple[bool, str | None]:
+    """
+    Dispara ao mesmo tempo as consultas (method, value, query, evento de falha,
+    campos do evento) e devolve o primeiro positivo na ordem de prioridade da
+    lista: a latência fica na da consulta mais lenta, não na soma de todas.
+    Consultas que ainda não começaram são canceladas assim que há resposta.
+    Sem probe_pool (criado por main), as consultas rodam uma de cada vez.
+    """
+    def probe(item):
+        _, _, query, fail_event, fail_fields = item
+        try:
+            return find_study(query, url, session)
+        except Exception as e:
+            jlog("warning", event=fail_event, error=str(e), **fail_fields)
+            return None
+
+    futures = [probe_pool.submit(probe, item) for item in probes[1:]] if probe_pool else []
+    try:
+        for i, item in enumerate(probes):
+            # A primeira roda nesta thread (sem pool, todas rodam aqui)
+            study_id = futures[i - 1].result() if i and futures else probe(item)
+            if study_id:
+                jlog("info", event="duplicate_found", method=item[0], value=item[1], study_id=study_id)
+                return True, study_id
+    finally:
+        for f in futures:
+            f.cancel()
+    return False, None
 
 
 # --- INÍCIO DO BLOCO ALTERADO ---
 def find_duplicate(accession: str | None, patient_id: str | None,
                    patient_name_dicom: str | None, patient_name_natural: str | None,
-                   study_date: str, url: str, headers: Dict[str, str]) -> Tuple[bool, str | None]:
+                   study_date: str, url: str, session: requests.Session,
+                   known_accessions: Dict[str, str | None] | None = None,
+                   known_dates: Dict[str, Dict[Tuple[str, str], str]] | None = None,
+                   probe_pool: ThreadPoolExecutor | None = None) -> Tuple[bool, str | None]:
     """
     Verifica duplicados com uma hierarquia robusta:
     1. AccessionNumber
     2. PatientID + StudyDate
     3. PatientName (formato DICOM: SOBRENOME^NOME) + StudyDate
     4. PatientName (formato Natural: NOME SOBRENOME) + StudyDate
+    Se o AccessionNumber já foi resolvido pela consulta em lote (known_accessions),
+    o passo 1 não vai à rede; se a StudyDate foi pré-carregada (known_dates), os
+    passos 2 a 4 são respondidos pelo índice local. Os passos que precisam do
+    Orthanc são consultados em paralelo, mantendo a ordem acima na resposta.
     """
-    with requests.Session() as s:
-        # 1) Por AccessionNumber
-        if accession:
-            try:
-                body = {"Level": "Study", "Query": {"AccessionNumber": accession}}
-                r = req_with_retry("POST", f"{url}/tools/find", s, {**headers, 'Content-Type': 'application/json'}, body, timeout=30)
-                data = r.json()
-                if data:
-                    jlog("info", event="duplicate_found", method="accession", value=accession, study_id=data[0])
-                    return True, data[0]
-            except Exception as e:
-                jlog("warning", event="find_accession_failed", accession=accession, error=str(e))
-
-        # 2) Por PatientID + StudyDate
-        if patient_id:
-            try:
-                body = {"Level": "Study", "Query": {"PatientID": patient_id, "StudyDate": study_date}}
-                r = req_with_retry("POST", f"{url}/tools/find", s, {**headers, 'Content-Type': 'application/json'}, body, timeout=30)
-                data = r.json()
-                if data:
-                    jlog("info", event="duplicate_found", method="patient_id_date", value=patient_id, study_id=data[0])
-                    return True, data[0]
-            except Exception as e:
-                jlog("warning", event="find_patient_date_failed", patient_id=patient_id, study_date=study_date, error=str(e))
-
-        # 3) Por PatientName (formato DICOM) + StudyDate
-        if patient_name_dicom:
-            try:
-                body = {"Level": "Study", "Query": {"PatientName": patient_name_dicom, "StudyDate": study_date}}
-                r = req_with_retry("POST", f"{url}/tools/find", s, {**headers, 'Content-Type': 'application/json'}, body, timeout=30)
-                data = r.json()
-                if data:
-                    jlog("info", event="duplicate_found", method="patient_name_dicom", value=patient_name_dicom, study_id=data[0])
-                    return True, data[0]
-            except Exception as e:
-                jlog("warning", event="find_patient_name_dicom_failed", name=patient_name_dicom, study_date=study_date, error=str(e))
-
-        # 4) Por PatientName (formato Natural) + StudyDate - Fallback final
-        if patient_name_natural and patient_name_natural.replace(" ", "") != patient_name_dicom.replace("^", ""):
-            try:
-                body = {"Level": "Study", "Query": {"PatientName": patient_name_natural, "StudyDate": study_date}}
-                r = req_with_retry("POST", f"{url}/tools/find", s, {**headers, 'Content-Type': 'application/json'}, body, timeout=30)
-                data = r.json()
-                if data:
-                    jlog("info", event="duplicate_found", method="patient_name_natural", value=patient_name_natural, study_id=data[0])
-                    return True, data[0]
-            except Exception as e:
-                jlog("warning", event="find_patient_name_natural_failed", name=patient_name_natural, study_date=study_date, error=str(e))
+    date_index = known_dates.get(study_date) if known_dates is not None else None
+    network = []
+
+    # 1) Por AccessionNumber
+    if accession and known_accessions is not None and accession in known_accessions:
+        study_id = known_accessions[accession]
+        if study_id:
+            jlog("info", event="duplicate_found", method="accession_batch", value=accession, study_id=study_id)
+            return True, study_id
+    elif accession:
+        network.append(("accession", accession, {"AccessionNumber": accession},
+                        "find_accession_failed", {"accession": accession}))
+
+    # 2) Por PatientID + StudyDate
+    if patient_id and date_index is not None:
+        study_id = date_index.get(('PatientID', patient_id))
+        if study_id:
+            jlog("info", event="duplicate_found", method="patient_id_date_batch", value=patient_id, study_id=study_id)
+            return True, study_id
+    elif patient_id:
+        network.append(("patient_id_date", patient_id, {"PatientID": patient_id, "StudyDate": study_date},
+                        "find_patient_date_failed", {"patient_id": patient_id, "study_date": study_date}))
+
+    # 3) Por PatientName (formato DICOM) + StudyDate
+    if patient_name_dicom and date_index is not None:
+        study_id = date_index.get(('PatientName', normalize_patient_name(patient_name_dicom)))
+        if study_id:
+            jlog("info", event="duplicate_found", method="patient_name_dicom_batch", value=patient_name_dicom,
+                 study_id=study_id)
+            return True, study_id
+    elif patient_name_dicom:
+        network.append(("patient_name_dicom", patient_name_dicom,
+                        {"PatientName": patient_name_dicom, "StudyDate": study_date},
+                        "find_patient_name_dicom_failed", {"name": patient_name_dicom, "study_date": study_date}))
+
+    # 4) Por PatientName (formato Natural) + StudyDate - Fallback final
+    # (o chamador passa None quando o formato natural repete o DICOM)
+    if patient_name_natural and date_index is not None:
+        study_id = date_index.get(('PatientName', normalize_patient_name(patient_name_natural)))
+        if study_id:
+            jlog("info", event="duplicate_found", method="patient_name_natural_batch", value=patient_name_natural,
+                 study_id=study_id)
+            return True, study_id
+    elif patient_name_natural:
+        network.append(("patient_name_natural", patient_name_natural,
+                        {"PatientName": patient_name_natural, "StudyDate": study_date},
+                        "find_patient_name_natural_failed", {"name": patient_name_natural, "study_date": study_date}))
 
-    return False, None
+    return run_network_probes(network, url, session, probe_pool)
 # --- FIM DO BLOCO ALTERADO ---
 
 
-def send_pdf_as_dicom(pdf_path: str, url: str, headers: Dict[str, str], tags: Dict[str, Any]) -> Dict[str, Any]:
-    size_mb = round(os.path.getsize(pdf_path) / (1024 * 1024), 2)
-    if size_mb > MAX_FILE_MB:
-        raise RuntimeError(f"PDF acima do limite permitido: {size_mb} MB > {MAX_FILE_MB} MB")
-    with open(pdf_path, 'rb') as f:
-        pdf_bytes = f.read()
-    pdf_b64 = base64.b64encode(pdf_bytes).decode()
-    payload = {"Tags": tags, "Content": f"data:application/pdf;base64,{pdf_b64}"}
+def iter_pdf_blocks(pdf_path: str) -> Iterator[memoryview]:
+    """
+    Percorre o PDF em blocos de B64_CHUNK lidos com readinto num único buffer
+    reaproveitado. Cada bloco sai cheio (múltiplo de 3, sem padding base64 no
+    meio do fluxo), exceto o último. Arquivo truncado durante a leitura só
+    encurta a leitura; quem chama confere o tamanho. Os blocos devem ser
+    consumidos antes de pedir o próximo.
+    """
+    buf = memoryview(bytearray(B64_CHUNK))
+    with open(pdf_path, 'rb', buffering=0) as f:
+        while True:
+            filled = 0
+            while filled < B64_CHUNK:
+                n = f.readinto(buf[filled:])  # leituras curtas acontecem em compartilhamentos de rede
+                if not n:
+                    break
+                filled += n
+            if filled:
+                yield buf[:filled]
+            if filled < B64_CHUNK:
+                return
+
+
+class CreateDicomBody:
+    """
+    Corpo JSON do /tools/create-dicom gerado sob demanda: o PDF é lido e
+    codificado em base64 por blocos à medida que o requests escreve no socket,
+    então a memória usada fica em um bloco, qualquer que seja o tamanho do
+    arquivo. O tamanho final é conhecido de antemão (envelope + base64 do
+    tamanho listado), e o envio usa Content-Length em vez de chunked.
+    seek(0) recomeça a leitura para uma nova tentativa.
+    """
+
+    def __init__(self, pdf_path: str, tags: Dict[str, Any], size_bytes: int):
+        self.pdf_path = pdf_path
+        self.size_bytes = size_bytes
+        self._prefix = b'{"Tags": ' + json.dumps(tags).encode() + b', "Content": "data:application/pdf;base64,'
+        self._suffix = b'"}'
+        self._len = len(self._prefix) + (size_bytes + 2) // 3 * 4 + len(self._suffix)
+        self._segments: Iterator[bytes] | None = None
+        self._buf = b''
+        self._pos = 0
+
+    def __len__(self) -> int:
+        return self._len
+
+    def _iter_segments(self) -> Iterator[bytes]:
+        # Confere antes do primeiro byte: o Orthanc não chega a receber um JSON cortado
+        if os.path.getsize(self.pdf_path) != self.size_bytes:
+            raise SourceFileChanged("PDF alterado depois da listagem (tamanho diferente do listado)")
+        yield self._prefix
+        read = 0
+        with contextlib.closing(iter_pdf_blocks(self.pdf_path)) as blocks:
+            for block in blocks:
+                read += len(block)
+                if read > self.size_bytes:
+                    raise SourceFileChanged("PDF alterado durante a leitura (tamanho diferente do listado)")
+                yield binascii.b2a_base64(block, newline=False)
+        if read != self.size_bytes:
+            raise SourceFileChanged("PDF alterado durante a leitura (tamanho diferente do listado)")
+        yield self._suffix
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if offset != 0 or whence != 0:
+            raise ValueError("CreateDicomBody só volta ao início")
+        self.close()
+        return 0
+
+    def read(self, size: int = -1) -> bytes:
+        if self._pos >= len(self._buf):
+            if self._segments is None:
+                self._segments = self._iter_segments()
+            self._buf = next(self._segments, b'')
+            self._pos = 0
+        if size is None or size < 0:
+            size = len(self._buf) - self._pos
+        out = self._buf[self._pos:self._pos + size]
+        self._pos += len(out)
+        return out
+
+    def close(self) -> None:
+        if self._segments is not None:
+            self._segments.close()
+        self._segments = None
+        self._buf = b''
+        self._pos = 0
+
+
+def send_pdf_as_dicom(pdf_path: str, url: str, session: requests.Session, tags: Dict[str, Any],
+                      size_bytes: int) -> Dict[str, Any]:
+    size_mb = round(size_bytes / (1024 * 1024), 2)
     timeout = max(60.0, 15.0 + size_mb * 1.5)  # timeout proporcional ao tamanho
-    with requests.Session() as s:
-        r = req_with_retry("POST", f"{url}/tools/create-dicom", s, {**headers, 'Content-Type': 'application/json'},
-                           payload, timeout=timeout)
-        return r.json()
+    with contextlib.closing(CreateDicomBody(pdf_path, tags, size_bytes)) as body:
+        r = req_with_retry("POST", f"{url}/tools/create-dicom", session, timeout=timeout, data=body)
+    return load_json(r)
 
 
 # -------------------------- PROCESSAMENTO --------------------------
 
-def process_file(full_path: str, orthanc_url: str, headers: Dict[str, str]) -> Dict[str, Any]:
+def deterministic_uid(*parts: str) -> str:
+    """UID DICOM no formato 2.25.<inteiro do UUID> (PS3.5 B.2), sempre o mesmo para as mesmas partes."""
+    return f"2.25.{uuid.uuid5(UID_NAMESPACE, '|'.join(parts)).int}"
+
+
+def mark_duplicate(full_path: str, parsed: Mapping, study_id: str | None) -> Dict[str, Any]:
+    name = os.path.basename(full_path)
+    jlog("info", event="duplicate_detected", file=name, accession=parsed.get('AccessionNumber'), study_id=study_id)
+    moved = move_file_safe(full_path, DUPLICATE_PATH, parsed['StudyDate'])
+    return {'Success': False, 'Skipped': True, 'Duplicate': True, 'AccessionNumber': parsed.get('AccessionNumber', ''),
+            'File': name, 'Reason': 'Estudo já existe', 'MovedTo': moved}
+
+
+def reject_if_too_large(full_path: str, size_bytes: int) -> Dict[str, Any] | None:
+    """Move para Erros o PDF acima de MAX_FILE_MB e devolve o resultado; None se o tamanho está dentro do limite."""
+    size_mb = round(size_bytes / (1024 * 1024), 2)
+    if size_mb <= MAX_FILE_MB:
+        return None
+    name = os.path.basename(full_path)
+    error = f"PDF acima do limite permitido: {size_mb} MB > {MAX_FILE_MB} MB"
+    jlog("error", event="file_too_large", file=name, error=error)
+    moved = move_file_safe(full_path, ERROR_PATH, '')
+    return {'Success': False, 'Error': error, 'File': name, 'MovedTo': moved}
+
+
+def process_file(full_path: str, size_bytes: int, parsed: Mapping, batch_time: str, orthanc_url: str,
+                 session: requests.Session,
+                 known_accessions: Dict[str, str | None] | None = None,
+                 known_dates: Dict[str, Dict[Tuple[str, str], str]] | None = None,
+                 probe_pool: ThreadPoolExecutor | None = None) -> Dict[str, Any]:
     name = os.path.basename(full_path)
     jlog("info", event="processing_start", file=name)
-    parsed = parse_filename(name)
     if not parsed['IsValid']:
         jlog("warning", event="invalid_format", file=name, reason=parsed['Error'])
         moved = move_file_safe(full_path, ERROR_PATH, '')
         return {'Success': False, 'Skipped': True, 'Reason': 'Formato de arquivo inválido', 'File': name,
                 'MovedTo': moved}
 
+    # Filtro local e barato antes de qualquer consulta ao Orthanc (o de tamanho já foi feito em main)
+    size_mb = round(size_bytes / (1024 * 1024), 2)
+    pdf_error = check_pdf_integrity(full_path, size_bytes)
+    if pdf_error:
+        jlog("warning", event="corrupted_pdf", file=name, reason=pdf_error)
+        moved = move_file_safe(full_path, ERROR_PATH, '')
+        return {'Success': False, 'Skipped': True, 'Reason': 'PDF corrompido', 'Error': pdf_error, 'File': name,
+                'MovedTo': moved}
+
     # Monta os dois formatos de nome para busca e para a tag
-    pn_parts_for_search = [parsed.get('LastName', ''), parsed.get('FirstName', ''), parsed.get('MiddleName', '')]
-    while pn_parts_for_search and not pn_parts_for_search[-1]:
-        pn_parts_for_search.pop()
-    patient_name_for_search = '^'.join(pn_parts_for_search)
-
-    name_parts_for_tag = [parsed.get('FirstName', ''), parsed.get('MiddleName', ''), parsed.get('LastName', '')]
-    patient_name_for_tag = ' '.join(part for part in name_parts_for_tag if part)
-
-    if not SKIP_DUP_CHECK:
-        # --- INÍCIO DO BLOCO ALTERADO ---
-        # A chamada da função agora passa os DOIS formatos de nome
-        exists, study_id = find_duplicate(
-            accession=parsed.get('AccessionNumber') or None,
-            patient_id=parsed.get('PatientID') or None,
-            patient_name_dicom=patient_name_for_search,
-            patient_name_natural=patient_name_for_tag,
-            study_date=parsed['StudyDate'],
-            url=orthanc_url,
-            headers=headers
-        )
-        # --- FIM DO BLOCO ALTERADO ---
-        if exists:
-            jlog("info", event="duplicate_detected", file=name, accession=parsed.get('AccessionNumber'),
-                 study_id=study_id)
-            moved = move_file_safe(full_path, DUPLICATE_PATH, parsed['StudyDate'])
-            return {'Success': False, 'Skipped': True, 'Duplicate': True,
-                    'AccessionNumber': parsed.get('AccessionNumber', ''), 'File': name, 'Reason': 'Estudo já existe',
-                    'MovedTo': moved}
-
-    hhmmss = dt.datetime.now().strftime('%H%M%S')
-    tags = {
-        "PatientName": patient_name_for_tag,
-        "StudyDescription": FIXED_EXAM['Type'],
-        "StudyDate": parsed['StudyDate'],
-        "StudyTime": hhmmss,
-        "SeriesDescription": f"{FIXED_EXAM['Type']} - PDF",
-        "SeriesDate": parsed['StudyDate'],
-        "SeriesTime": hhmmss,
-        "SeriesNumber": "1",
-        "Modality": FIXED_EXAM['Modality'],
-        "ContentDate": parsed['StudyDate'],
-        "ContentTime": hhmmss,
-        "InstanceNumber": "1",
-        "InstitutionName": INSTITUTION_NAME,
-        "ReferringPhysicianName": REFERRING_PHYSICIAN,
-        "SOPClassUID": SOPCLASS_PDF
-    }
-    if parsed['PatientID']:
-        tags['PatientID'] = parsed['PatientID']
-    if parsed['AccessionNumber']:
-        tags['AccessionNumber'] = parsed['AccessionNumber']
+    last_name, first_name, middle_name = parsed['LastName'], parsed['FirstName'], parsed['MiddleName']
+    # Componentes vazios no fim saem do PN (SOBRENOME^NOME, não SOBRENOME^NOME^)
+    patient_name_for_search = '^'.join((last_name, first_name, middle_name)).rstrip('^')
+    patient_name_for_tag = ' '.join(filter(None, (first_name, middle_name, last_name)))
+    # A busca pelo formato natural só acrescenta algo se as letras aparecem em outra ordem
+    natural_differs = patient_name_for_tag.replace(" ", "") != patient_name_for_search.replace("^", "")
+
+    # Arquivos com a mesma chave de duplicidade são verificados e enviados um de cada vez,
+    # senão dois workers consultam o índice antes de qualquer um registrar o envio
+    dup_keys = [] if SKIP_DUP_CHECK else duplicate_keys(parsed, [patient_name_for_search, patient_name_for_tag])
+    with duplicate_key_guard(dup_keys):
+        if not SKIP_DUP_CHECK:
+            # --- INÍCIO DO BLOCO ALTERADO ---
+            # A chamada da função agora passa os DOIS formatos de nome
+            exists, study_id = find_duplicate(
+                accession=parsed.get('AccessionNumber') or None,
+                patient_id=parsed.get('PatientID') or None,
+                patient_name_dicom=patient_name_for_search,
+                patient_name_natural=patient_name_for_tag if natural_differs else None,
+                study_date=parsed['StudyDate'],
+                url=orthanc_url,
+                session=session,
+                known_accessions=known_accessions,
+                known_dates=known_dates,
+                probe_pool=probe_pool
+            )
+            # --- FIM DO BLOCO ALTERADO ---
+            if exists:
+                return mark_duplicate(full_path, parsed, study_id)
+
+        tags = {
+            **STATIC_TAGS,
+            "PatientName": patient_name_for_tag,
+            "StudyDate": parsed['StudyDate'],
+            "StudyTime": batch_time,
+            "SeriesDate": parsed['StudyDate'],
+            "SeriesTime": batch_time,
+            "ContentDate": parsed['StudyDate'],
+            "ContentTime": batch_time
+        }
+        if parsed['PatientID']:
+            tags['PatientID'] = parsed['PatientID']
+        if parsed['AccessionNumber']:
+            tags['AccessionNumber'] = parsed['AccessionNumber']
+        if USE_DETERMINISTIC_UIDS:
+            # Identidade do documento: IDs quando existem, senão nome + data (LEGADO)
+            if parsed['AccessionNumber']:
+                identity = (parsed['PatientID'], parsed['AccessionNumber'], parsed['StudyDate'])
+            else:
+                identity = (patient_name_for_tag, parsed['StudyDate'])
+            tags['StudyInstanceUID'] = deterministic_uid('study', *identity)
+            tags['SeriesInstanceUID'] = deterministic_uid('series', *identity)
+            tags['SOPInstanceUID'] = deterministic_uid('instance', *identity)
 
-    try:
-        resp = send_pdf_as_dicom(full_path, orthanc_url, headers, tags)
-        size_mb = round(os.path.getsize(full_path) / (1024 * 1024), 2)
-        jlog("info", event="sent_success", file=name, size_mb=size_mb, instance_id=resp.get('ID'))
-        moved = move_file_safe(full_path, PROCESSED_PATH, parsed['StudyDate'])
-        return {'Success': True, 'InstanceId': resp.get('ID'), 'FileSize': size_mb, 'File': name, 'MovedTo': moved}
-    except Exception as e:
-        jlog("error", event="send_failed", file=name, error=str(e))
-        moved = move_file_safe(full_path, ERROR_PATH, '')
-        return {'Success': False, 'Error': str(e), 'File': name, 'MovedTo': moved}
+        try:
+            resp = send_pdf_as_dicom(full_path, orthanc_url, session, tags, size_bytes)
+            if USE_DETERMINISTIC_UIDS and resp.get('Status') == 'AlreadyStored':
+                # O Orthanc já tinha este SOPInstanceUID e não gravou nada: é um reenvio
+                return mark_duplicate(full_path, parsed, resp.get('ParentStudy'))
+            jlog("info", event="sent_success", file=name, size_mb=size_mb, instance_id=resp.get('ID'))
+            # O estudo agora existe: arquivos seguintes do lote com a mesma chave são duplicados
+            register_uploaded_study(resp.get('ParentStudy') or resp.get('ID'), parsed['AccessionNumber'],
+                                    parsed['PatientID'], [patient_name_for_search, patient_name_for_tag],
+                                    parsed['StudyDate'], known_accessions, known_dates)
+            moved = move_file_safe(full_path, PROCESSED_PATH, parsed['StudyDate'])
+            return {'Success': True, 'InstanceId': resp.get('ID'), 'FileSize': size_mb, 'File': name, 'MovedTo': moved}
+        except Exception as e:
+            jlog("error", event="send_failed", file=name, error=str(e))
+            moved = move_file_safe(full_path, ERROR_PATH, '')
+            return {'Success': False, 'Error': str(e), 'File': name, 'MovedTo': moved}
 
 
 # -------------------------- MAIN --------------------------
 
-def main():
+def run_batch():
     logger.info("=== PDF para Orthanc v2 (Python) ===")
 
     folder = PDF_SOURCE_FOLDER
@@ -498,46 +1026,75 @@ def main():
 
     ensure_dirs()
 
-    headers = get_auth_header(ORTHANC_USER, ORTHANC_PASSWORD)
-    connected, info = test_orthanc_connection(ORTHANC_URL, headers)
-    if not connected:
-        logger.error(f"Falha na conexão com Orthanc: {info}")
-        return
-    logger.info(f"Conectado ao Orthanc, versão: {info}")
-
-    files = [f for f in os.listdir(folder) if f.lower().endswith('.pdf')]
-    if len(files) == 0:
-        logger.warning("Nenhum arquivo PDF encontrado na pasta.")
-        return
-
-    logger.info(f"Arquivos encontrados: {len(files)} | workers={MAX_WORKERS}")
-
-    total_ok = 0
-    total_dup = 0
-    total_err = 0
-
-    file_paths = [os.path.join(folder, f) for f in files]
-
-    if MAX_WORKERS > 1:
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
-            futures = {ex.submit(process_file, p, ORTHANC_URL, headers): p for p in file_paths}
-            for fut in as_completed(futures):
-                res = fut.result()
-                if res.get('Success'):
-                    total_ok += 1
-                elif res.get('Duplicate'):
-                    total_dup += 1
-                else:
-                    total_err += 1
-    else:
-        for p in file_paths:
-            res = process_file(p, ORTHANC_URL, headers)
-            if res.get('Success'):
-                total_ok += 1
-            elif res.get('Duplicate'):
-                total_dup += 1
-            else:
+    with create_session(BASE_HEADERS) as session:
+        connected, info = test_orthanc_connection(ORTHANC_URL, session)
+        if not connected:
+            logger.error(f"Falha na conexão com Orthanc: {info}")
+            return
+        logger.info(f"Conectado ao Orthanc, versão: {info}")
+
+        # scandir traz nome, caminho e tipo numa única listagem; o tamanho vai junto para os workers
+        with os.scandir(folder) as it:
+            entries = [e for e in it if e.is_file() and e.name.lower().endswith('.pdf')]
+        if len(entries) == 0:
+            logger.warning("Nenhum arquivo PDF encontrado na pasta.")
+            return
+
+        logger.info(f"Arquivos encontrados: {len(entries)} | workers={MAX_WORKERS}")
+
+        total_ok = 0
+        total_dup = 0
+        total_err = 0
+
+        # Os nomes são interpretados aqui, uma vez, antes do pool: os workers só fazem rede e disco
+        work = [(e.path, e.stat().st_size, parse_filename(e.name)) for e in entries]
+        # Arquivos acima do limite saem aqui, sem ocupar um worker nem entrar nas consultas em lote
+        # (os de nome inválido seguem para o worker, que os move com o motivo de formato)
+        accepted = []
+        for p, size, parsed in work:
+            if parsed['IsValid'] and reject_if_too_large(p, size):
                 total_err += 1
+            else:
+                accepted.append((p, size, parsed))
+        work = accepted
+        # Horário de processamento (StudyTime/SeriesTime/ContentTime) único para o lote
+        batch_time = dt.datetime.now().strftime('%H%M%S')
+
+        known_accessions = None
+        known_dates = None
+        if not SKIP_DUP_CHECK:
+            # Resolve as chaves de duplicidade do lote de uma vez, antes de despachar os arquivos
+            parsed_all = [parsed for _, _, parsed in work if parsed['IsValid']]
+            known_accessions = prefetch_accessions([p['AccessionNumber'] for p in parsed_all if p['AccessionNumber']],
+                                                   ORTHANC_URL, session)
+            known_dates = prefetch_study_dates([p['StudyDate'] for p in parsed_all], ORTHANC_URL, session)
+
+        # Buscas de duplicidade que não couberam nos índices em lote rodam em paralelo neste pool
+        # (dimensionado junto com o HTTPAdapter da sessão); criado só aqui e encerrado ao fim da execução
+        with ThreadPoolExecutor(max_workers=PROBE_THREADS, thread_name_prefix="find") as probe_pool:
+            if MAX_WORKERS > 1:
+                with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+                    futures = {ex.submit(process_file, p, size, parsed, batch_time, ORTHANC_URL, session,
+                                         known_accessions, known_dates, probe_pool): p
+                               for p, size, parsed in work}
+                    for fut in as_completed(futures):
+                        res = fut.result()
+                        if res.get('Success'):
+                            total_ok += 1
+                        elif res.get('Duplicate'):
+                            total_dup += 1
+                        else:
+                            total_err += 1
+            else:
+                for p, size, parsed in work:
+                    res = process_file(p, size, parsed, batch_time, ORTHANC_URL, session, known_accessions,
+                                       known_dates, probe_pool)
+                    if res.get('Success'):
+                        total_ok += 1
+                    elif res.get('Duplicate'):
+                        total_dup += 1
+                    else:
+                        total_err += 1
 
     summary = {"processados": total_ok, "Duplicados": total_dup, "erros": total_err}
     jlog("info", event="summary", **summary)
@@ -547,5 +1104,20 @@ def main():
     print(f"  Erros: {total_err}")
 
 
+def main():
+    # Troca os handlers diretos pela fila só durante o lote; o finally devolve tudo ao estado da importação
+    logger.removeHandler(ch)
+    logger.removeHandler(fh)
+    logger.addHandler(log_queue_handler)
+    log_listener.start()
+    try:
+        run_batch()
+    finally:
+        logger.removeHandler(log_queue_handler)
+        log_listener.stop()  # grava o que ainda estava na fila
+        logger.addHandler(ch)
+        logger.addHandler(fh)
+
+
 if __name__ == "__main__":
     main()